@@ -11,15 +11,28 @@ import torch.nn as nn
 from torch.nn import functional as F
 from tqdm import tqdm
 
+try:
+    from torch.cuda.amp import autocast
+except ImportError:  # mixed precision needs torch >= 1.6
+    autocast = None
+
 class _BaseWrapper(object):
 
-    def __init__(self, model, use_nbdt=False, nbdt_node_wnid=None):
+    def __init__(self, model, use_nbdt=False, nbdt_node_wnid=None, amp=False):
         super(_BaseWrapper, self).__init__()
+        assert not amp or autocast is not None, \
+            "Mixed precision requires torch.cuda.amp (torch >= 1.6)"
         self.device = next(model.parameters()).device
         self.model = model
         self.handlers = []  # a set of hook function handlers
         self.use_nbdt = use_nbdt
         self.nbdt_node_wnid = nbdt_node_wnid
+        self.amp = amp
+        self.num_images = 1
+        # Backbone outputs of the last forward pass, keyed by the caller. Only
+        # one entry is kept, since each entry holds on to its autograd graph.
+        self._fwd_key = None
+        self._fwd_outputs = None
 
     def _encode_one_hot(self, labels):
         one_hot = torch.zeros_like(self.logits).to(self.device)
@@ -29,22 +42,48 @@ class _BaseWrapper(object):
     def set_nbdt_node_wnid(self, wnid):
         self.nbdt_node_wnid = wnid
 
-    def forward(self, image):
-        self.image_shape = image.shape[2:]
+    def _forward_logits(self, image, key=None):
+        if key is None or key != self._fwd_key:
+            backbone = self.model.model if self.use_nbdt else self.model
+            # Drop every reference to the previous graph before building the
+            # next one, so that only one graph is alive at peak
+            self._fwd_key, self._fwd_outputs = None, None
+            self.logits = self.probs = None
+            if hasattr(self, 'activations'):
+                self.activations.clear()
+            self._fwd_outputs = backbone(image)
+            self._fwd_key = key
+        outputs = self._fwd_outputs
+
         if self.use_nbdt:
             assert self.nbdt_node_wnid in self.model.rules.wnid_to_node.keys(), \
                 "NBDT node wnid must be in {}; node wnid {} not found".format(self.model.rules.wnid_to_node.keys(), self.nbdt_node_wnid)
             from nbdt.utils import coerce_tensor
-            outputs = self.model.model(image)
             n,c,h,w = outputs.shape
             coerced_outputs = coerce_tensor(outputs)
             nbdt_node = self.model.rules.wnid_to_node[self.nbdt_node_wnid]
             node_logits = self.model.rules.get_node_logits(coerced_outputs, nbdt_node)
-            self.logits = node_logits.reshape(n,h,w,node_logits.shape[-1]).permute(0,3,1,2)
+            return node_logits.reshape(n,h,w,node_logits.shape[-1]).permute(0,3,1,2)
+        return outputs
+
+    def forward(self, image, key=None):
+        """
+        If key matches the previous call, the backbone is not run again and
+        only the NBDT node logits are recomputed (e.g. for a new node wnid).
+        """
+        self.image_shape = image.shape[2:]
+        self.num_images = image.shape[0]
+        if self.amp:
+            with autocast():
+                self.logits = self._forward_logits(image, key)
         else:
-            self.logits = self.model(image)
-        self.logits = F.interpolate(self.logits, self.image_shape)
-        self.probs = F.softmax(self.logits, dim=1)
+            self.logits = self._forward_logits(image, key)
+        # Upsampling, softmax and sorting stay in fp32. Layers that ran under
+        # autocast still backpropagate in fp16, unscaled.
+        self.logits = F.interpolate(self.logits.float(), self.image_shape)
+        # With pixel batching, each image is repeated for batch_size samples
+        step = self.logits.shape[0] // self.num_images
+        self.probs = F.softmax(self.logits[::step], dim=1)
         return self.probs.sort(dim=1, descending=True)  # ordered results
 
     def backward(self, labels):
@@ -54,6 +93,7 @@ class _BaseWrapper(object):
         one_hot = self._encode_one_hot(labels)
         self.model.zero_grad()
         self.logits.backward(gradient=one_hot, retain_graph=True)
+        self.grad_images = None
 
     def generate(self):
         raise NotImplementedError
@@ -73,21 +113,39 @@ class GradCAM(_BaseWrapper):
     Look at Figure 2 on page 4
     """
 
-    def __init__(self, model, candidate_layers=None, use_nbdt=False, nbdt_node_wnid=None):
-        super(GradCAM, self).__init__(model, use_nbdt, nbdt_node_wnid)
+    def __init__(self, model, candidate_layers=None, use_nbdt=False,
+            nbdt_node_wnid=None, batch_size=1, amp=False):
+        super(GradCAM, self).__init__(model, use_nbdt, nbdt_node_wnid, amp)
         self.fmap_pool = {}
         self.grad_pool = {}
+        self.grad_images = None  # image of each gradient, if not its index
+        self.activations = {}  # non-detached outputs, used by batch_backward
         self.candidate_layers = candidate_layers  # list
+        self.batch_size = batch_size
 
         def save_fmaps(key):
             def forward_hook(module, input, output):
-                self.fmap_pool[key] = output.detach()
+                # Samples downstream of an expanded activation repeat each
+                # image, so keep one per image. This is a view, so it shares
+                # storage with the activation and costs no extra memory.
+                step = max(output.shape[0] // self.num_images, 1)
+                self.fmap_pool[key] = output[::step].detach()
+                # Repeat the first hooked activation batch_size times per
+                # image (without copying, for a single image), so that every
+                # layer downstream of it computes one sample per pixel in the
+                # backward pass.
+                if self.batch_size > 1 and output.shape[0] == self.num_images:
+                    shape = output.shape[1:]
+                    output = output.unsqueeze(1).expand(
+                        -1, self.batch_size, *shape).reshape(-1, *shape)
+                self.activations[key] = output
+                return output
 
             return forward_hook
 
         def save_grads(key):
             def backward_hook(module, grad_in, grad_out):
-                self.grad_pool[key] = grad_out[0].detach()
+                self.grad_pool[key] = grad_out[0].detach().float()
 
             return backward_hook
 
@@ -103,36 +161,39 @@ class GradCAM(_BaseWrapper):
         else:
             raise ValueError("Invalid layer name: {}".format(target_layer))
 
-    @staticmethod
-    def normalize(gcam):
-        B, C, H, W = gcam.shape
-        gcam = gcam.view(B, -1)
-        gcam -= gcam.min(dim=1, keepdim=True)[0]
-        gcam /= gcam.max(dim=1, keepdim=True)[0]
-        gcam = gcam.view(B, C, H, W)
-        return gcam
-
-    @staticmethod
-    def normalize_np(gcam, maximum=None, minimum=None):
-        B, C, H, W = gcam.shape
-        view = gcam.view()
-        view.shape = (B, -1)
-
-        lower = minimum or view.min(axis=1)
-        view -= lower
-
-        if maximum:
-            view /= (maximum - lower)
-        else:
-            upper = view.max(axis=1)
-            view[upper != 0] /= upper[upper != 0][:, None]
-
-        view.shape = (B, C, H, W)
-        return view
-
-    def generate(self, target_layer, normalize=True):
+    def _find_fmaps(self, target_layer, index=None):
+        """
+        If index is given, returns the feature maps of the image that the
+        index-th gradient was computed for
+        """
         fmaps = self._find(self.fmap_pool, target_layer)
+        if index is not None:
+            image = index if self.grad_images is None else self.grad_images[index]
+            fmaps = fmaps[[image]]
+        return fmaps.float()
+
+    def _find_grads(self, target_layer, index=None):
         grads = self._find(self.grad_pool, target_layer)
+        if index is not None:
+            grads = grads[[index]]
+        return grads
+
+    @staticmethod
+    def normalize_inplace(gcam, minimum=None, maximum=None, eps=1e-8):
+        """
+        Scales gcam to [0, 1] in place. Bounds that are not given are taken
+        per sample, along the first dimension. eps guards against flat maps.
+        """
+        per_sample = (-1,) + (1,) * (gcam.dim() - 1)
+        if minimum is None:
+            minimum = gcam.reshape(gcam.shape[0], -1).min(dim=1)[0].view(per_sample)
+        if maximum is None:
+            maximum = gcam.reshape(gcam.shape[0], -1).max(dim=1)[0].view(per_sample)
+        return gcam.sub_(minimum).div_(maximum - minimum + eps)
+
+    def generate(self, target_layer, normalize=True, index=None):
+        fmaps = self._find_fmaps(target_layer, index)
+        grads = self._find_grads(target_layer, index)
         weights = F.adaptive_avg_pool2d(grads, 1)
 
         gcam = torch.mul(fmaps, weights).sum(dim=1, keepdim=True)
@@ -142,7 +203,7 @@ class GradCAM(_BaseWrapper):
         )
 
         if normalize:
-            gcam = GradCAM.normalize(gcam)
+            gcam = GradCAM.normalize_inplace(gcam)
         return gcam
 
 
@@ -161,13 +222,51 @@ class _SegBaseWrapper(_BaseWrapper):
         one_hot = self._encode_one_hot(labels, pixel_i, pixel_j)
         self.model.zero_grad()
         self.logits.backward(gradient=one_hot, retain_graph=True)
+        self.grad_images = None
+
+    def batch_backward(self, labels, pixels, images=None):
+        """
+        Class and pixel specific backpropagation for a batch of pixels
+
+        images[k] is the image (within the forward batch) of pixels[k], and
+        defaults to the first image. Each image has batch_size samples of the
+        expanded logits, and each sample only receives the gradient for one
+        pixel, so a single backward pass yields one gradient per pixel.
+        """
+        self.grad_pool.clear()
+        pixel_i, pixel_j = torch.as_tensor(
+            pixels, dtype=torch.long, device=self.device).reshape(-1, 2).t()
+        images = [0] * len(pixel_i) if images is None else [int(image) for image in images]
+
+        samples_per_image = self.logits.shape[0] // self.num_images
+        slots, counts = [], {}
+        for image in images:
+            counts[image] = counts.get(image, 0) + 1
+            assert counts[image] <= samples_per_image, \
+                "Got more than {} pixels for image {}".format(samples_per_image, image)
+            slots.append(image * samples_per_image + counts[image] - 1)
+        slots = torch.tensor(slots, dtype=torch.long, device=self.device)
+        image_indices = torch.tensor(images, dtype=torch.long, device=self.device)
+
+        # Backpropagate from the selected logits directly, rather than
+        # building a dense one-hot mask the size of the expanded logits
+        selected = self.logits[
+            slots, labels[image_indices, 0, pixel_i, pixel_j], pixel_i, pixel_j]
+
+        keys = list(self.activations.keys())
+        grads = torch.autograd.grad(
+            selected.sum(), [self.activations[key] for key in keys],
+            retain_graph=True, allow_unused=True)
+        self.grad_pool = {key: grad[slots].detach().float()
+                          for key, grad in zip(keys, grads) if grad is not None}
+        self.grad_images = images
 
 
 class GradPAM(_SegBaseWrapper, GradCAM):
 
-    def generate(self, target_layer, normalize=True):
-        fmaps = self._find(self.fmap_pool, target_layer)
-        grads = self._find(self.grad_pool, target_layer)
+    def generate(self, target_layer, normalize=True, index=None):
+        fmaps = self._find_fmaps(target_layer, index)
+        grads = self._find_grads(target_layer, index)
         weights = grads
 
         gcam = torch.mul(fmaps, weights).sum(dim=1, keepdim=True)
@@ -177,15 +276,15 @@ class GradPAM(_SegBaseWrapper, GradCAM):
         )
 
         if normalize:
-            gcam = GradCAM.normalize(gcam)
+            gcam = GradCAM.normalize_inplace(gcam)
         return gcam
 
 
 class SegNormGrad(_SegBaseWrapper, GradCAM):
 
-    def generate(self, target_layer, normalize=True):
-        fmaps = self._find(self.fmap_pool, target_layer)
-        grads = self._find(self.grad_pool, target_layer)
+    def generate(self, target_layer, normalize=True, index=None):
+        fmaps = self._find_fmaps(target_layer, index)
+        grads = self._find_grads(target_layer, index)
 
         unfold_act = F.unfold(fmaps, kernel_size=3, padding=1)
         unfold_act = unfold_act.view(1, fmaps.shape[1] * 9, fmaps.shape[2], fmaps.shape[3])
@@ -197,7 +296,7 @@ class SegNormGrad(_SegBaseWrapper, GradCAM):
         )
 
         if normalize:
-            gcam = GradCAM.normalize(gcam)
+            gcam = GradCAM.normalize_inplace(gcam)
         return gcam
 
 
@@ -7,10 +7,11 @@ import sys
 import logging
 import time
 import timeit
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import cv2
-import random
 import numpy as np
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
@@ -29,7 +30,6 @@ from utils.gradcam import GradPAM, GradPAMWhole, SegNormGrad, SegNormGradWhole,
     GradCAM, SegGradCAM
 from utils.modelsummary import get_model_summary
 from utils.utils import create_logger
-from collections import defaultdict
 
 METHODS = {
     'GradPAM': GradPAM,
@@ -40,6 +40,43 @@ METHODS = {
     'SegGradCAM': SegGradCAM
 }
 
+# Images and arrays are encoded and written in the background, so the GPU
+# can move on to the next pixel. cv2.imwrite and file writes release the GIL.
+IO_WORKERS = 4
+IO_POOL = ThreadPoolExecutor(max_workers=IO_WORKERS)
+IO_FUTURES = []
+
+def imwrite(path, image, params=()):
+    if not cv2.imwrite(path, image, list(params)):
+        raise IOError('Could not write image to {}'.format(path))
+
+def submit_save(fn, *args):
+    """Runs fn(*args) in the background. Re-raises errors from finished
+    writes, and blocks while too many writes (and their buffers) are queued."""
+    pending = []
+    for future in IO_FUTURES:
+        if future.done():
+            future.result()
+        else:
+            pending.append(future)
+    while len(pending) >= 2 * IO_WORKERS:
+        pending.pop(0).result()
+    IO_FUTURES[:] = pending + [IO_POOL.submit(fn, *args)]
+
+def wait_for_saves():
+    while IO_FUTURES:
+        IO_FUTURES.pop(0).result()
+
+# BGR lookup table for the 'hot' colormap, applied with cv2.LUT
+HOT_LUT = np.ascontiguousarray(
+    cm.hot(np.arange(256), bytes=True)[:, 2::-1]).reshape(256, 1, 3)
+
+# Building a new figure for every pixel dominates save_overlap, so a single
+# figure is created on first use, then cleared and redrawn.
+@lru_cache(maxsize=1)
+def get_overlap_plot():
+    return plt.subplots()
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Visualize GradCAM')
 
@@ -67,6 +104,23 @@ def parse_args():
                         help='Range for pixel i. Expects [start, end) and step.')
     parser.add_argument('--pixel-j-range', type=int, nargs=3,
                         help='Range for pixel j. Expects [start, end) and step.')
+    parser.add_argument('--pixel-batch-size', type=int, default=1,
+                        help='Number of pixels to backpropagate from at once. '
+                             'Values above 1 expand the first target layer '
+                             'along the batch dimension, so every layer after '
+                             'it must accept a batch (e.g., last_layer.3). '
+                             'Memory grows linearly: each extra pixel adds a '
+                             'full-resolution copy of the logits (~160 MB '
+                             'for 19 classes at 1024x2048).')
+    parser.add_argument('--image-batch-size', type=int, default=1,
+                        help='Number of images to run the forward pass on at '
+                             'once. All images must have the same size.')
+    parser.add_argument('--amp', action='store_true',
+                        help='Run the forward pass in mixed precision '
+                             '(requires torch >= 1.6). Gradients from the '
+                             'logits back to the target layer are then '
+                             'computed in fp16 without loss scaling, so weak '
+                             'single-pixel gradients may underflow to zero.')
     parser.add_argument('--pixel-cartesian-product', action='store_true',
                         help='Compute cartesian product between all is and js '
                              'for the full list of pixels.')
@@ -113,11 +167,10 @@ def get_pixels(pixel_i, pixel_j, pixel_i_range, pixel_j_range, cartesian_product
         return sum([ [(i, j) for i in pixel_is] for j in pixel_js ], [])
     return list(zip(pixel_is, pixel_js))
 
-def compute_output_coord(pixel_i, pixel_j, image_shape, output_shape):
-    ratio_i, ratio_j = output_shape[0]/image_shape[0], output_shape[1]/image_shape[1]
-    out_pixel_i = int(np.floor(pixel_i * ratio_i))
-    out_pixel_j = int(np.floor(pixel_j * ratio_j))
-    return out_pixel_i, out_pixel_j
+def compute_output_coords(pixels, image_shape, output_shape):
+    """Maps an (N, 2) array of (i, j) image pixels to output pixels"""
+    ratio = np.array([output_shape[0]/image_shape[0], output_shape[1]/image_shape[1]])
+    return np.floor(pixels * ratio).astype(np.int64)
 
 def retrieve_raw_image(dataset, index):
     item = dataset.files[index]
@@ -127,18 +180,26 @@ def retrieve_raw_image(dataset, index):
 
 def save_gradcam(save_path, gradcam, raw_image, paper_cmap=False,
         minimum=None, maximum=None, save_npy=True):
-    gradcam = gradcam.cpu().numpy()
     np_save_path = save_path.replace('.jpg', '.npy')
     if save_npy:
-        np.save(np_save_path, gradcam)
-    gradcam = GradCAM.normalize_np(gradcam, minimum=minimum, maximum=maximum)[0,0]
-    cmap = cm.hot(gradcam)[..., 2::-1] * 255.0
+        # The map is not modified after this point (see compute_overlap), so
+        # the queued write can share its host memory
+        submit_save(np.save, np_save_path, gradcam.cpu().numpy())
+
+    # Normalize and quantize on the map's device, so only one byte per pixel
+    # is copied to the host. Everything after the clone happens in place.
+    gradcam = gradcam[0,0].clone()
+    minimum = minimum or gradcam.min()
+    maximum = maximum or gradcam.max()
+    GradCAM.normalize_inplace(gradcam, minimum, maximum).clamp_(0, 1).mul_(255)
+    gradcam = gradcam.to(torch.uint8).cpu().numpy()
+    cmap = cv2.LUT(cv2.merge([gradcam, gradcam, gradcam]), HOT_LUT)
     if paper_cmap:
-        alpha = gradcam[..., None]
+        alpha = gradcam[..., None].astype(np.float32) / 255
         gradcam = alpha * cmap + (1 - alpha) * raw_image
     else:
-        gradcam = (cmap.astype(np.float) + raw_image.astype(np.float)) / 2
-    cv2.imwrite(save_path, np.uint8(gradcam), [cv2.IMWRITE_JPEG_QUALITY, 50])
+        gradcam = cv2.addWeighted(cmap, 0.5, raw_image, 0.5, 0)
+    submit_save(imwrite, save_path, np.uint8(gradcam), [cv2.IMWRITE_JPEG_QUALITY, 50])
 
 def generate_output_dir(output_dir, vis_mode, target_layer, use_nbdt,
         nbdt_node_wnid, crop_size=0, cls=None):
@@ -172,13 +233,17 @@ def generate_fname(kwargs, order=('image', 'pixel_i', 'pixel_j')):
     return '-'.join(parts)
 
 def compute_overlap(label, gradcam):
-    cls_to_mass = {}
-    gradcam = GradCAM.normalize(gradcam)[0,0]
-    for cls in map(int, np.unique(label.tolist())):
-        selector = label == cls
-        cls_to_mass[cls] = gradcam[selector].sum() / selector.sum()
-    cls_to_mass.pop(255)  # the 'ignore' label
-    return cls_to_mass
+    """Expects label as a tensor on the same device as gradcam"""
+    # Normalize a device-side copy, leaving the caller's map untouched
+    gradcam = GradCAM.normalize_inplace(gradcam.clone())[0,0].reshape(-1)
+    label = label.reshape(-1).long()
+
+    # Sum saliency and count pixels for every class in a single pass. The
+    # 'ignore' label (255) gets its own bin and is dropped below.
+    sums = torch.bincount(label, weights=gradcam, minlength=256).tolist()
+    counts = torch.bincount(label, minlength=256).tolist()
+    return {cls: sums[cls] / counts[cls]
+            for cls in range(len(class_names)) if counts[cls] > 0}
 
 def save_overlap(save_path_overlap, save_path_plot, gradcam, label, k=5, save_npy=True):
     overlap = compute_overlap(label, gradcam)
@@ -186,14 +251,14 @@ def save_overlap(save_path_overlap, save_path_plot, gradcam, label, k=5, save_np
     max_labels = [class_names[key] for key in max_keys]
     max_values = [overlap[key] for key in max_keys]
     if save_npy:
-        np.save(save_path_overlap, overlap)
+        submit_save(np.save, save_path_overlap, overlap)
 
-    plt.figure()
-    plt.title('Average saliency per class')
-    plt.barh(max_labels, max_values)
-    plt.xlabel('Average Pixel Normalized Saliency')
-    plt.savefig(save_path_plot)
-    plt.close()
+    fig, ax = get_overlap_plot()
+    ax.clear()
+    ax.set_title('Average saliency per class')
+    ax.barh(max_labels, max_values)
+    ax.set_xlabel('Average Pixel Normalized Saliency')
+    fig.savefig(save_path_plot)
 
 def get_image_indices(image_index, image_index_range):
     if image_index_range:
@@ -209,23 +274,24 @@ def crop(i, j, size, image, is_tensor=True):
     return image[slice_i, slice_j, ...]
 
 def get_random_pixels(n, pixels, bin_size=300, seed=0):
-    random.seed(seed)
-
-    bin_to_pixels = defaultdict(lambda: [])
-    for (i, j) in pixels:
-        bin_to_pixels[(i // bin_size, j // bin_size)].append((i, j))
-
-    if n >= len(bin_to_pixels):
-        pixels_per_bins = bin_to_pixels.values()
-    else:
-        bins = random.sample(bin_to_pixels.keys(), n)
-        pixels_per_bins = [bin_to_pixels[bin] for bin in bins]
-
-    pixels = []
-    for pixels_per_bin in pixels_per_bins:
-        indices = random.sample(range(len(pixels_per_bin)), 1)
-        pixels.append(pixels_per_bin[indices[0]])
-    return pixels
+    pixels = pixels.cpu().numpy() if torch.is_tensor(pixels) else np.asarray(pixels)
+    if len(pixels) == 0:
+        return []
+    rng = np.random.default_rng(seed)
+
+    # Pack the (i, j) bin of every pixel into one integer key
+    bins = (pixels[:, 0] // bin_size).astype(np.int64) << 32 \
+        | (pixels[:, 1] // bin_size).astype(np.int64)
+    unique_bins, inverse = np.unique(bins, return_inverse=True)
+    chosen_bins = rng.choice(len(unique_bins), size=min(n, len(unique_bins)),
+                             replace=False)
+
+    # Group pixels by bin once, then sample one pixel inside each chosen bin
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse)
+    starts = np.cumsum(counts) - counts
+    chosen = order[starts[chosen_bins] + rng.integers(counts[chosen_bins])]
+    return [tuple(pixel) for pixel in pixels[chosen]]
 
 def main():
     args = parse_args()
@@ -295,10 +361,12 @@ def main():
     if args.target_layers:
         target_layers = args.target_layers.split(',')
     else:
-        for name, module in list(model.named_modules())[::-1]:
+        last_conv = None
+        for name, module in model.named_modules():
             if isinstance(module, nn.Conv2d):
-                target_layers = [name]
-            break
+                last_conv = name
+        assert last_conv is not None, 'Model has no Conv2d layer to target'
+        target_layers = [last_conv]
     logger.info('Target layers set to {}'.format(str(target_layers)))
 
     # Append model. to target layers if using nbdt
@@ -306,20 +374,19 @@ def main():
         target_layers = ['model.' + layer for layer in target_layers]
 
     def generate_and_save_saliency(
-            image_index, pixel_i=None, pixel_j=None, crop_size=None,
-            normalize=False):
+            raw_image, pixel_i=None, pixel_j=None, crop_size=None,
+            normalize=False, batch_index=None):
         """too lazy to move out to global lol"""
         nonlocal maximum, minimum, label
         # Generate GradCAM + save heatmap
         heatmaps = []
-        raw_image = retrieve_raw_image(test_dataset, image_index)
 
         should_crop = crop_size is not None and pixel_i is not None and pixel_j is not None
         if should_crop:
             raw_image = crop(pixel_i, pixel_j, crop_size, raw_image, is_tensor=False)
 
         for layer in target_layers:
-            gradcam_region = gradcam.generate(target_layer=layer, normalize=False)
+            gradcam_region = gradcam.generate(target_layer=layer, normalize=False, index=batch_index)
 
             if should_crop:
                 gradcam_region = crop(pixel_i, pixel_j, crop_size, gradcam_region, is_tensor=True)
@@ -334,7 +401,7 @@ def main():
             logger.info('Saving {} heatmap at {}...'.format(args.vis_mode, save_path))
 
             if normalize:
-                gradcam_region = GradCAM.normalize(gradcam_region)
+                gradcam_region = GradCAM.normalize_inplace(gradcam_region)
                 save_gradcam(save_path, gradcam_region, raw_image, save_npy=not args.skip_save_npy)
             else:
                 save_gradcam(save_path, gradcam_region, raw_image, minimum=minimum, maximum=maximum, save_npy=not args.skip_save_npy)
@@ -343,7 +410,7 @@ def main():
             os.makedirs(output_dir_original, exist_ok=True)
             save_path_original = generate_save_path(output_dir_original, gradcam_kwargs, ext='jpg')
             logger.info('Saving {} original at {}...'.format(args.vis_mode, save_path_original))
-            cv2.imwrite(save_path_original, raw_image)
+            submit_save(imwrite, save_path_original, raw_image)
 
             if crop_size and pixel_i and pixel_j:
                 continue
@@ -377,44 +444,43 @@ def main():
         path_nodes = leaf_to_path_nodes[leaf]
         nbdt_node_wnids = [item['node'].wnid for item in path_nodes if item['node']]
 
-    def run():
+    def run(image_indices, images, labels, raw_images):
         nonlocal maximum, minimum, label, gradcam_kwargs
-        for image_index in get_image_indices(args.image_index, args.image_index_range):
-            image, label, _, name = test_dataset[image_index]
-            image = torch.from_numpy(image).unsqueeze(0).to(device)
-            logger.info("Using image {}...".format(name))
-            pred_probs, pred_labels = gradcam.forward(image)
-
+        # The backbone forward pass is shared by all nodes of the same images
+        pred_probs, pred_labels = gradcam.forward(images, key=tuple(image_indices))
+        whole_image = getattr(Saliency, 'whole_image', False)
+
+        if whole_image:
+            assert not (
+                    args.pixel_i or args.pixel_j or args.pixel_i_range
+                    or args.pixel_j_range), \
+                'the "Whole" saliency method generates one map for the whole ' \
+                'image, not for specific pixels'
+            gradcam.backward(pred_labels[:,[0],:,:])
+
+        # Saliency bounds of each image, swapped in while its maps are saved
+        bounds = {}
+        image_pixels = []
+        for position, image_index in enumerate(image_indices):
+            label = labels[position]
             maximum, minimum = -1000, 0
             logger.info(f'=> Starting bounds: ({minimum}, {maximum})')
 
-            if args.crop_for and class_names.index(args.crop_for) not in label:
-                print(f'Skipping image {image_index} because no {args.crop_for} found')
-                continue
-
-            if getattr(Saliency, 'whole_image', False):
-                assert not (
-                        args.pixel_i or args.pixel_j or args.pixel_i_range
-                        or args.pixel_j_range), \
-                    'the "Whole" saliency method generates one map for the whole ' \
-                    'image, not for specific pixels'
+            if whole_image:
                 gradcam_kwargs = {'image': image_index}
                 if args.suffix:
                     gradcam_kwargs['suffix'] = args.suffix
-                gradcam.backward(pred_labels[:,[0],:,:])
 
-                generate_and_save_saliency(image_index)
+                with torch.no_grad():
+                    generate_and_save_saliency(raw_images[position], batch_index=position)
+            bounds[position] = (maximum, minimum)
 
-                if args.crop_size <= 0:
-                    continue
+            if whole_image and args.crop_size <= 0:
+                continue
 
             if args.crop_for:
                 cls_index = class_names.index(args.crop_for)
-                label = torch.Tensor(label).to(pred_labels.device)
-                # is_right_class = pred_labels[0,0,:,:] == cls_index
-                # is_correct = pred_labels == label
-                is_right_class = is_correct = label == cls_index  #TODO:tmp
-                pixels = (is_right_class * is_correct).nonzero()
+                pixels = torch.nonzero(label == cls_index, as_tuple=False)
 
                 pixels = get_random_pixels(args.pixel_max_num_random, pixels, seed=cls_index)
             else:
@@ -422,47 +488,123 @@ def main():
                 pixels = get_pixels(
                     args.pixel_i, args.pixel_j, args.pixel_i_range, args.pixel_j_range,
                     args.pixel_cartesian_product)
-            logger.info(f'Running on {len(pixels)} pixels.')
-
-            for pixel_i, pixel_j in pixels:
-                pixel_i, pixel_j = int(pixel_i), int(pixel_j)
-                assert pixel_i < test_size[0] and pixel_j < test_size[1], \
-                    "Pixel ({},{}) is out of bounds for image of size ({},{})".format(
-                        pixel_i,pixel_j,test_size[0],test_size[1])
-
-                # Run backward pass
-                # Note: Computes backprop wrt most likely predicted class rather than gt class
-                gradcam_kwargs = {'image': image_index, 'pixel_i': pixel_i, 'pixel_j': pixel_j}
-                if args.suffix:
-                    gradcam_kwargs['suffix'] = args.suffix
-                logger.info(f'Running {args.vis_mode} on image {image_index} at pixel ({pixel_i},{pixel_j}). Using filename suffix: {args.suffix}')
-                output_pixel_i, output_pixel_j = compute_output_coord(pixel_i, pixel_j, test_size, pred_probs.shape[2:])
-
-                if not getattr(Saliency, 'whole_image', False):
-                    gradcam.backward(pred_labels[:, [0], :, :], output_pixel_i, output_pixel_j)
-
-                if args.crop_size <= 0:
-                    generate_and_save_saliency(image_index)
-                else:
-                    generate_and_save_saliency(image_index, pixel_i, pixel_j, args.crop_size)
-
-            logger.info(f'=> Final bounds are: ({minimum}, {maximum})')
+            logger.info(f'Running on {len(pixels)} pixels of image {image_index}.')
+
+            pixels = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+            out_of_bounds = (pixels[:, 0] >= test_size[0]) | (pixels[:, 1] >= test_size[1])
+            assert not out_of_bounds.any(), \
+                "Pixel ({},{}) is out of bounds for image of size ({},{})".format(
+                    *pixels[out_of_bounds][0],test_size[0],test_size[1])
+            output_pixels = compute_output_coords(pixels, test_size, pred_probs.shape[2:])
+            image_pixels.append((position, pixels, output_pixels))
+
+        num_pixels = max([len(pixels) for _, pixels, _ in image_pixels], default=0)
+        for start in range(0, num_pixels, batch_size):
+            batch = slice(start, start + batch_size)
+            chunk = [(position, pixels[batch], output_pixels[batch])
+                     for position, pixels, output_pixels in image_pixels
+                     if len(pixels[batch])]
+
+            # Run one backward pass for up to batch_size pixels of every image
+            # Note: Computes backprop wrt most likely predicted class rather than gt class
+            if not whole_image:
+                gradcam.batch_backward(
+                    pred_labels[:, [0], :, :],
+                    np.concatenate([output_pixels for _, _, output_pixels in chunk]),
+                    images=np.concatenate([
+                        np.full(len(pixels), position) for position, pixels, _ in chunk]))
+
+            batch_index = 0
+            with torch.no_grad():
+                for position, pixels, _ in chunk:
+                    image_index = image_indices[position]
+                    label = labels[position]
+                    maximum, minimum = bounds[position]
+
+                    for pixel_i, pixel_j in pixels.tolist():
+                        gradcam_kwargs = {'image': image_index, 'pixel_i': pixel_i, 'pixel_j': pixel_j}
+                        if args.suffix:
+                            gradcam_kwargs['suffix'] = args.suffix
+                        logger.info(f'Running {args.vis_mode} on image {image_index} at pixel ({pixel_i},{pixel_j}). Using filename suffix: {args.suffix}')
+
+                        index = position if whole_image else batch_index
+                        if args.crop_size <= 0:
+                            generate_and_save_saliency(raw_images[position], batch_index=index)
+                        else:
+                            generate_and_save_saliency(raw_images[position], pixel_i, pixel_j, args.crop_size, batch_index=index)
+                        batch_index += 1
+
+                    bounds[position] = (maximum, minimum)
+
+        for position, image_index in enumerate(image_indices):
+            maximum, minimum = bounds[position]
+            logger.info(f'=> Final bounds for image {image_index} are: ({minimum}, {maximum})')
 
     # Instantiate wrapper once, outside of loop
     Saliency = METHODS[args.vis_mode]
+    batch_size = 1 if getattr(Saliency, 'whole_image', False) else args.pixel_batch_size
     gradcam = Saliency(model=model, candidate_layers=target_layers,
-        use_nbdt=config.NBDT.USE_NBDT, nbdt_node_wnid=None)
+        use_nbdt=config.NBDT.USE_NBDT, nbdt_node_wnid=None,
+        batch_size=batch_size, amp=args.amp)
+
+    def load_image(image_index):
+        image, label, _, name = test_dataset[image_index]
+        image = torch.from_numpy(image).unsqueeze(0)
+        label = torch.from_numpy(label)
+        if device == 'cuda':  # pinned memory allows asynchronous copies
+            image, label = image.pin_memory(), label.pin_memory()
+        # Decode the raw image once per image, for all of its pixels and nodes
+        raw_image = retrieve_raw_image(test_dataset, image_index)
+        return image, label, name, raw_image
+
+    def load_image_batches():
+        """Yields lists of (image_index, image, label, raw_image),
+        args.image_batch_size images at a time. The next image is loaded in the
+        background while the current batch is processed."""
+        image_indices = list(get_image_indices(args.image_index, args.image_index_range))
+        if not image_indices:
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as load_pool:
+            next_image = load_pool.submit(load_image, image_indices[0])
+
+            batch = []
+            for i, image_index in enumerate(image_indices):
+                image, image_label, name, raw_image = next_image.result()
+                if i + 1 < len(image_indices):
+                    next_image = load_pool.submit(load_image, image_indices[i + 1])
+
+                if args.crop_for and class_names.index(args.crop_for) not in image_label:
+                    print(f'Skipping image {image_index} because no {args.crop_for} found')
+                    continue
+
+                logger.info("Using image {}...".format(name))
+                batch.append((image_index, image, image_label, raw_image))
+                if len(batch) == args.image_batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
 
     maximum, minimum, label, gradcam_kwargs = -1000, 0, None, {}
-    for nbdt_node_wnid in nbdt_node_wnids:
-        if config.NBDT.USE_NBDT:
-            logger.info("Using logits from node with wnid {}...".format(nbdt_node_wnid))
-        gradcam.set_nbdt_node_wnid(nbdt_node_wnid)
-        run()
-
-    if not nbdt_node_wnids:
-        nbdt_node_wnid = None
-        run()
+    for batch in load_image_batches():
+        image_indices = [image_index for image_index, _, _, _ in batch]
+        images = torch.cat([
+            image.to(device, non_blocking=True) for _, image, _, _ in batch])
+        labels = [
+            image_label.to(device, non_blocking=True) for _, _, image_label, _ in batch]
+        raw_images = [raw_image for _, _, _, raw_image in batch]
+
+        # Loop over nodes inside the image loop, so that every node reuses
+        # the images' backbone forward pass
+        for nbdt_node_wnid in nbdt_node_wnids or [None]:
+            if nbdt_node_wnid is not None:
+                if config.NBDT.USE_NBDT:
+                    logger.info("Using logits from node with wnid {}...".format(nbdt_node_wnid))
+                gradcam.set_nbdt_node_wnid(nbdt_node_wnid)
+            run(image_indices, images, labels, raw_images)
+
+    wait_for_saves()
 
 
 if __name__ == '__main__':